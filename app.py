@@ -1,14 +1,36 @@
 import re
 import os
+import json
 import math
+import heapq
 import time
-import urllib.parse
+import hashlib
+import asyncio
+import threading
+from urllib.parse import quote_plus
+from dataclasses import dataclass
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
+from spotipy.cache_handler import CacheHandler
 from spotipy.exceptions import SpotifyException
 import toml
+import diskcache
+
+_ARTIST_URI_RE = re.compile(r'(?:spotify:artist:|open\.spotify\.com/artist/)([A-Za-z0-9]{22})')
+_ARTIST_ID_RE = re.compile(r'[A-Za-z0-9]{22}\Z')
+
+_STREAM_TEMPLATES = (
+    ("Spotify", "https://open.spotify.com/search/%s"),
+    ("Apple Music", "https://music.apple.com/us/search?term=%s"),
+    ("Deezer", "https://www.deezer.com/search/%s"),
+    ("YouTube Music", "https://music.youtube.com/search?q=%s"),
+)
 
 # 1. PAGE CONFIG
 st.set_page_config(page_title="🎵 TuneWeaver MVP", layout="wide")
@@ -24,141 +46,388 @@ else:
     CLIENT_ID = os.getenv("SPOTIPY_CLIENT_ID")
     CLIENT_SECRET = os.getenv("SPOTIPY_CLIENT_SECRET")
 
-if not CLIENT_ID or not CLIENT_SECRET:
+# Cache policy for Spotify responses: enabled (default) | replay | write_only | disabled.
+# replay serves only from the disk cache and never calls Spotify, so it runs without credentials.
+# write_only and disabled bypass every cache layer (in-memory, session and disk reads) and always call Spotify.
+CACHE_MODE = os.getenv("TUNEWEAVER_CACHE_MODE", "enabled").strip().lower()
+if CACHE_MODE not in ("enabled", "replay", "write_only", "disabled"):
+    st.error(f"Unknown TUNEWEAVER_CACHE_MODE '{CACHE_MODE}'—use enabled, replay, write_only or disabled.")
+    st.stop()
+
+if (not CLIENT_ID or not CLIENT_SECRET) and CACHE_MODE != "replay":
     st.error("Spotify credentials not found—set SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET.")
     st.stop()
 
 # 3. INIT SPOTIFY CLIENT
+class LockedTokenCache(CacheHandler):
+    """
+    Thread-safe token cache: kept in memory under a lock, loaded from disk once and written back atomically.
+    """
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._token = None
+        try:
+            with open(cache_path) as f:
+                self._token = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            pass
+
+    def get_cached_token(self):
+        with self._lock:
+            return self._token
+
+    def save_token_to_cache(self, token_info):
+        with self._lock:
+            self._token = token_info
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(token_info, f)
+                os.replace(tmp_path, self.cache_path)
+            except OSError:
+                # Disk persistence is best-effort; the in-memory token still serves this process
+                pass
+
+
 @st.cache_resource
 def get_spotify_client():
     try:
-        manager = SpotifyClientCredentials(client_id=CLIENT_ID, client_secret=CLIENT_SECRET)
-        return spotipy.Spotify(client_credentials_manager=manager)
+        # Long-lived pooled session so the top-tracks fan-out reuses TLS connections.
+        # Only connect errors are retried here; status retries (429, 5xx) go through
+        # safe_sp_call so each attempt takes a token from the shared limiter.
+        session = requests.Session()
+        retry = Retry(total=3, read=False, backoff_factor=0.3)
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retry)
+        session.mount("https://", adapter)
+        # Token is persisted to disk so a restarted worker skips the /api/token round-trip
+        manager = SpotifyClientCredentials(client_id=CLIENT_ID, client_secret=CLIENT_SECRET,
+                                           cache_handler=LockedTokenCache(".spotify_token_cache"),
+                                           requests_session=session)
+        return spotipy.Spotify(client_credentials_manager=manager, requests_session=session)
     except Exception as e:
         st.error(f"Failed to initialize Spotify client: {e}")
         return None
 
-sp = get_spotify_client()
-if not sp:
+sp = get_spotify_client() if CLIENT_ID and CLIENT_SECRET else None
+if not sp and CACHE_MODE != "replay":
     st.stop()
 
-# 4. UTILITY FUNCTIONS
+# 4. RATE LIMITING
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: refills at `rate` tokens/second up to `capacity`.
+    """
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_update = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+                self.last_update = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+@st.cache_resource
+def get_rate_limiter():
+    # ~180 requests/minute, shared by every session and worker thread
+    return TokenBucket(rate=180 / 60, capacity=20)
+
+limiter = get_rate_limiter()
+
+# 5. PERSISTENT CACHE
+
+class ReplayCacheMiss(RuntimeError):
+    """
+    Raised in replay mode when a response is not in the disk cache.
+    """
+
+
+@st.cache_resource
+def get_disk_cache():
+    # Survives restarts and is shared across sessions
+    return diskcache.Cache(os.path.join(".cache", "spotify"))
+
+_dc = get_disk_cache()
+
+
+def _memory_cache(fn):
+    """
+    In-memory st.cache_data layer (24h) over disk-cached lookups.
+    Skipped in write_only/disabled modes so every call reaches _cached_call.
+    """
+    if CACHE_MODE in ("write_only", "disabled"):
+        return fn
+    return st.cache_data(ttl=86400, show_spinner=False)(fn)
+
+# 6. UTILITY FUNCTIONS
+
+@dataclass(slots=True)
+class Track:
+    name: str
+    artist: str
+    duration_ms: int
+    duration_str: str  # mm:ss, formatted once at build time
+
+
+def rate_limited_call(fn, *args, **kwargs):
+    """
+    Wait for a token from the shared limiter, then call fn.
+    """
+    limiter.acquire()
+    return fn(*args, **kwargs)
+
+
+MAX_ATTEMPTS = 5
+
 
 def safe_sp_call(fn, *args, **kwargs):
     """
     Wrap Spotify API calls to handle rate limits and API errors.
+    Throttled (429) and transient 5xx calls are retried at most MAX_ATTEMPTS times.
     """
-    try:
-        return fn(*args, **kwargs)
-    except SpotifyException as e:
-        status = e.http_status
-        if status == 429:
-            retry = int(e.headers.get('Retry-After', 1))
-            time.sleep(retry)
-            return safe_sp_call(fn, *args, **kwargs)
-        elif status in (401, 403):
-            st.error(f"Auth error ({status}): {e}")
-        elif status == 404:
-            return None
-        else:
-            st.warning(f"Spotify API error ({status}): {e}")
-    except Exception as e:
-        st.warning(f"Unexpected error: {e}")
-    return None
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return rate_limited_call(fn, *args, **kwargs)
+        except SpotifyException as e:
+            status = e.http_status
+            if status == 429:
+                # spotipy reports exhausted transport retries as a 429 without Retry-After
+                retry_after = (e.headers or {}).get('Retry-After')
+                if retry_after is None or attempt == MAX_ATTEMPTS:
+                    st.warning(f"Spotify API error ({status}): {e}")
+                    return None
+                time.sleep(int(retry_after))
+                continue
+            elif status in (500, 502, 503, 504) and attempt < MAX_ATTEMPTS:
+                time.sleep(0.3 * 2 ** (attempt - 1))
+                continue
+            elif status in (401, 403):
+                st.error(f"Auth error ({status}): {e}")
+            elif status == 404:
+                return None
+            else:
+                st.warning(f"Spotify API error ({status}): {e}")
+        except Exception as e:
+            st.warning(f"Unexpected error: {e}")
+        return None
+
+
+def _cached_call(fn_name: str, *args, ttl=86400, **kwargs):
+    """
+    Call sp.<fn_name> via safe_sp_call, persisting successful results on disk keyed by SHA256(endpoint, args).
+    Lookup and storage follow CACHE_MODE; a miss in replay mode raises ReplayCacheMiss.
+    """
+    key = hashlib.sha256(repr((fn_name, args, sorted(kwargs.items()))).encode()).hexdigest()
+    if CACHE_MODE in ("enabled", "replay"):
+        result = _dc.get(key)
+        if result is not None:
+            return result
+        if CACHE_MODE == "replay":
+            raise ReplayCacheMiss(f"cache miss in replay mode ({fn_name})")
+    result = safe_sp_call(getattr(sp, fn_name), *args, **kwargs)
+    if result is not None and CACHE_MODE != "disabled":
+        _dc.set(key, result, expire=ttl)
+    return result
+
+
+async def _run_in_executor(fn, *args):
+    """
+    Run a blocking call on the default executor, keeping st.* calls inside it attached to this session.
+    """
+    ctx = get_script_run_ctx()
+
+    def call():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+
+    return await asyncio.get_running_loop().run_in_executor(None, call)
 
 
 def extract_artist_id(input_str: str) -> str:
     """
     Extract Spotify artist ID from a URI or URL, or return the input if it matches the ID pattern.
     """
-    m = re.search(r'(?:spotify:artist:|open\.spotify\.com/artist/)([A-Za-z0-9]+)', input_str)
+    m = _ARTIST_URI_RE.search(input_str)
     if m:
         return m.group(1)
     # Fallback: if input is 22-char base62 ID
-    if re.fullmatch(r'[A-Za-z0-9]{22}', input_str):
+    if _ARTIST_ID_RE.match(input_str):
         return input_str
     return None
 
 
-@st.cache_data(ttl=3600, show_spinner=False)
-def search_artist(name_or_id: str) -> dict | None:
+def _normalize(s: str) -> str:
+    return s.strip().casefold()
+
+
+class _LookupFailed(Exception):
     """
-    Search by name or fetch directly by ID if given.
+    Raised inside memoized lookups when the API call failed, so st.cache_data doesn't store the miss.
     """
-    artist_id = extract_artist_id(name_or_id)
-    if artist_id:
-        return safe_sp_call(sp.artist, artist_id)
-    # Name search
-    res = safe_sp_call(sp.search, q=f"artist:{name_or_id}", type="artist", limit=1)
-    if res and res.get('artists', {}).get('items'):
-        return res['artists']['items'][0]
-    return None
 
 
-@st.cache_data(ttl=3600, show_spinner=False)
-def fetch_artist_details(ids: list[str]) -> list[dict]:
+def search_artist(user_input: str) -> dict | None:
     """
-    Batch-fetch artist details (up to 50 per request).
+    Search by name or fetch directly by ID if given.
+    Names are normalized so trivially different spellings share one cache entry; IDs are case-sensitive.
     """
-    def chunked(lst, n):
-        for i in range(0, len(lst), n):
-            yield lst[i:i+n]
+    artist_id = extract_artist_id(user_input.strip())
+    try:
+        if artist_id:
+            return _search_by_id(artist_id)
+        return _search_by_name(_normalize(user_input))
+    except _LookupFailed:
+        return None
+
+
+@_memory_cache
+def _search_by_id(artist_id: str) -> dict | None:
+    res = _cached_call('artist', artist_id)
+    if res is None:
+        raise _LookupFailed(artist_id)
+    return res
+
+
+@_memory_cache
+def _search_by_name(name: str) -> dict | None:
+    res = _cached_call('search', q=f"artist:{name}", type="artist", limit=1)
+    if res is None:
+        raise _LookupFailed(name)
+    if res.get('artists', {}).get('items'):
+        return res['artists']['items'][0]
+    return None
+
 
-    details = []
-    for chunk in chunked(ids, 50):
-        res = safe_sp_call(sp.artists, chunk)
-        if res and res.get('artists'):
-            details.extend(res['artists'])
-    return details
+def _raw_related(artist_id: str) -> dict | None:
+    # No in-memory layer: st.cache_data would also keep a transient-error None for 24h,
+    # while the disk cache stores only successful responses
+    return _cached_call('artist_related_artists', artist_id)
 
 
 def get_related_artists(artist_id: str, num_artists=10, popularity_threshold=60) -> list[dict]:
     """
     Fetch related artists, filter by popularity, and return the least popular ones.
+    Only the fetch is cached (on disk), so threshold/count changes never hit the API.
     """
-    res = safe_sp_call(sp.artist_related_artists, artist_id)
+    res = _raw_related(artist_id)
     if not res or not res.get('artists'):
         return []
-    ids = [a['id'] for a in res['artists']]
-    artists = fetch_artist_details(ids)
-    lesser = [a for a in artists if a.get('popularity', 100) < popularity_threshold]
-    lesser.sort(key=lambda x: x.get('popularity', 100))
-    return lesser[:num_artists]
+    # artist_related_artists already returns full artist objects (popularity, genres, images...)
+    lesser = res['artists']
+    if popularity_threshold < 100:
+        lesser = [a for a in lesser if a.get('popularity', 100) < popularity_threshold]
+    return heapq.nsmallest(num_artists, lesser, key=lambda x: x.get('popularity', 100))
 
 
 def get_artist_top_tracks(artist_id: str, num_tracks=2, market='BE') -> list[dict]:
     """
     Return the top tracks for an artist in the specified market.
     """
-    res = safe_sp_call(sp.artist_top_tracks, artist_id, market=market)
+    res = _cached_call('artist_top_tracks', artist_id, market=market)
     return res.get('tracks', [])[:num_tracks] if res else []
 
 
+async def _get_top_tracks_async(artist_id: str, num_tracks=2, market='BE') -> list[dict]:
+    return await _run_in_executor(get_artist_top_tracks, artist_id, num_tracks, market)
+
+
+async def fetch_all_top_tracks(artist_ids: list[str], num_tracks=2, market='BE') -> list[list[dict]]:
+    """
+    Fetch top tracks for all artists concurrently; results keep the order of artist_ids.
+    """
+    return await asyncio.gather(*[_get_top_tracks_async(a, num_tracks, market) for a in artist_ids])
+
+
 def generate_streaming_links(track_name: str, artist_name: str) -> dict[str,str]:
-    q = urllib.parse.quote_plus(f"{track_name} {artist_name}")
-    return {
-        "Spotify": f"https://open.spotify.com/search/{q}",
-        "Apple Music": f"https://music.apple.com/us/search?term={q}",
-        "Deezer": f"https://www.deezer.com/search/{q}",
-        "YouTube Music": f"https://music.youtube.com/search?q={q}",
-    }
+    q = quote_plus(f"{track_name} {artist_name}")
+    return {name: tpl % q for name, tpl in _STREAM_TEMPLATES}
 
 
-def generate_playlist_search_link(tracks: list[dict]) -> dict[str,str]:
+def generate_playlist_search_link(tracks: list[Track]) -> dict[str,str]:
     """
     Create search URLs for the first few tracks of the playlist.
     """
     if not tracks:
         return {}
-    parts = [f"{t['name']} {t['artist']}" for t in tracks[:4]]
-    q = urllib.parse.quote_plus(", ".join(parts))
-    return {
-        "Spotify": f"https://open.spotify.com/search/{q}",
-        "Apple Music": f"https://music.apple.com/us/search?term={q}",
-        "Deezer": f"https://www.deezer.com/search/{q}",
-    }
-
-# 5. STREAMLIT UI
+    parts = [f"{t.name} {t.artist}" for t in tracks[:4]]
+    q = quote_plus(", ".join(parts))
+    # Playlist search covers Spotify, Apple Music and Deezer only
+    return {name: tpl % q for name, tpl in _STREAM_TEMPLATES[:3]}
+
+
+def build_playlist(seed_artist: dict, related: list[dict], target_ms=60*60*1000) -> tuple[list[Track], int]:
+    """
+    Weave seed + related artists' top tracks into a playlist of about target_ms.
+    """
+    playlist, total_ms = [], 0
+    avg_track_ms, tracks_per_artist = 210000, 2
+    # Fetch top tracks (seed first) concurrently, only for as many artists as the
+    # remaining budget needs plus a small margin; fetch more if still short
+    sources = [seed_artist] + related
+    pos = 0
+    while total_ms < target_ms and pos < len(sources):
+        needed = math.ceil((target_ms - total_ms) / (avg_track_ms * tracks_per_artist)) + 2
+        batch = sources[pos:pos + needed]
+        pos += len(batch)
+        top_tracks = asyncio.run(fetch_all_top_tracks([a['id'] for a in batch], tracks_per_artist))
+        flat = ((art['name'], t) for art, tracks in zip(batch, top_tracks) for t in tracks[:tracks_per_artist])
+        for name, t in flat:
+            if total_ms >= target_ms:
+                break
+            secs = t['duration_ms']//1000
+            playlist.append(Track(t['name'], name, t['duration_ms'], f"{secs//60:02d}:{secs%60:02d}"))
+            total_ms += t['duration_ms']
+    return playlist, total_ms
+
+# 7. STREAMLIT UI
+
+def render_results(seed_artist: dict, related: list[dict], playlist: list[Track], total_ms: int):
+    st.success(f"Seed: **{seed_artist['name']}** (Pop: {seed_artist.get('popularity')})")
+    if not related:
+        st.warning("No lesser-known related artists found—try adjusting the threshold.")
+        return
+
+    st.subheader("Suggested Artists")
+    cols = st.columns(min(len(related), 5))
+    for i, art in enumerate(related):
+        with cols[i % len(cols)]:
+            if art.get('images'):
+                st.image(art['images'][-1]['url'], width=100)
+            genres = ", ".join(art.get('genres', [])[:3])
+            followers = art.get('followers', {}).get('total', 'N/A')
+            st.markdown(f"**{art['name']}** (Pop: {art.get('popularity')})\n\n"+
+                        f"Genres: {genres}\n\nFollowers: {followers}")
+            st.markdown(f"[Open on Spotify]({art['external_urls']['spotify']})")
+
+    # Display playlist
+    if not playlist:
+        st.warning("Could not build a playlist—no tracks found.")
+        return
+    mins = math.ceil(total_ms/60000)
+    st.subheader(f"🎶 Your Playlist (~{mins} minutes)")
+    for idx, tr in enumerate(playlist, 1):
+        st.write(f"{idx}. **{tr.name}** by {tr.artist} ({tr.duration_str})")
+        links = generate_streaming_links(tr.name, tr.artist)
+        st.markdown(" | ".join(f"[{s}]({u})" for s, u in links.items()))
+
+    st.subheader("🔗 Search Full Playlist")
+    full_links = generate_playlist_search_link(playlist)
+    for svc, url in full_links.items():
+        st.markdown(f"- [{svc}]({url})")
+
+
 st.title("🎵 TuneWeaver MVP")
 st.markdown("Discover lesser-known artists related to your favorites and weave a ~1-hour playlist.")
 
@@ -175,63 +444,36 @@ with st.form(key="tune_form"):
 if submit:
     if not seed_input.strip():
         st.warning("Please enter a seed artist.")
+        st.session_state.pop("results", None)
     else:
-        with st.spinner("Building your playlist…"):
-            seed_artist = search_artist(seed_input)
-            if not seed_artist:
-                st.error(f"No artist found for '{seed_input}'.")
-            else:
-                st.success(f"Seed: **{seed_artist['name']}** (Pop: {seed_artist.get('popularity')})")
-                related = get_related_artists(seed_artist['id'], n_suggestions, pop_thresh)
-                if not related:
-                    st.warning("No lesser-known related artists found—try adjusting the threshold.")
-                else:
-                    st.subheader("Suggested Artists")
-                    cols = st.columns(min(len(related), 5))
-                    for i, art in enumerate(related):
-                        with cols[i % len(cols)]:
-                            if art.get('images'):
-                                st.image(art['images'][-1]['url'], width=100)
-                            genres = ", ".join(art.get('genres', [])[:3])
-                            followers = art.get('followers', {}).get('total', 'N/A')
-                            st.markdown(f"**{art['name']}** (Pop: {art.get('popularity')})\n\n"+
-                                        f"Genres: {genres}\n\nFollowers: {followers}")
-                            st.markdown(f"[Open on Spotify]({art['external_urls']['spotify']})")
-
-                    # Build ~1-hour playlist
-                    playlist, total_ms = [], 0
-                    target_ms = 60*60*1000
-                    # Add seed tracks
-                    for t in get_artist_top_tracks(seed_artist['id'], 2):
-                        if total_ms < target_ms:
-                            playlist.append({"name": t['name'], "artist": seed_artist['name'], "duration_ms": t['duration_ms']})
-                            total_ms += t['duration_ms']
-                    # Add related tracks
-                    for art in related:
-                        if total_ms >= target_ms:
-                            break
-                        for t in get_artist_top_tracks(art['id'], 2):
-                            if total_ms < target_ms:
-                                playlist.append({"name": t['name'], "artist": art['name'], "duration_ms": t['duration_ms']})
-                                total_ms += t['duration_ms']
-                            else:
-                                break
-                    # Display playlist
-                    if not playlist:
-                        st.warning("Could not build a playlist—no tracks found.")
+        # Results are kept in session_state; resubmitting the same inputs skips the fetch entirely.
+        # Keyed like the search caches: IDs keep their case, names are normalized.
+        seed_key = extract_artist_id(seed_input.strip()) or _normalize(seed_input)
+        key = (seed_key, n_suggestions, pop_thresh)
+        reuse = CACHE_MODE in ("enabled", "replay")
+        if not reuse or st.session_state.get("results", {}).get("key") != key:
+            st.session_state.pop("results", None)
+            with st.spinner("Building your playlist…"):
+                try:
+                    seed_artist = search_artist(seed_input)
+                    if not seed_artist:
+                        st.error(f"No artist found for '{seed_input}'.")
                     else:
-                        mins = math.ceil(total_ms/60000)
-                        st.subheader(f"🎶 Your Playlist (~{mins} minutes)")
-                        for idx, tr in enumerate(playlist, 1):
-                            mm, ss = divmod(tr['duration_ms']//1000, 60)
-                            st.write(f"{idx}. **{tr['name']}** by {tr['artist']} ({mm:02d}:{ss:02d})")
-                            links = generate_streaming_links(tr['name'], tr['artist'])
-                            st.markdown(" | ".join(f"[{s}]({u})" for s, u in links.items()))
-
-                        st.subheader("🔗 Search Full Playlist")
-                        full_links = generate_playlist_search_link(playlist)
-                        for svc, url in full_links.items():
-                            st.markdown(f"- [{svc}]({url})")
+                        related = get_related_artists(seed_artist['id'], n_suggestions, pop_thresh)
+                        playlist, total_ms = build_playlist(seed_artist, related) if related else ([], 0)
+                        st.session_state["results"] = {
+                            "key": key,
+                            "seed_artist": seed_artist,
+                            "related": related,
+                            "playlist": playlist,
+                            "total_ms": total_ms,
+                        }
+                except ReplayCacheMiss as e:
+                    st.error(str(e))
+
+results = st.session_state.get("results")
+if results:
+    render_results(results["seed_artist"], results["related"], results["playlist"], results["total_ms"])
 
 st.markdown("---")
 st.caption("Powered by Spotify Web API • MVP by TuneWeaver")